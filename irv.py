@@ -1,17 +1,80 @@
+import secrets
+import time
 from functools import wraps
+from itertools import groupby
+from operator import itemgetter
+from smtplib import (SMTPConnectError, SMTPRecipientsRefused,
+        SMTPResponseException, SMTPServerDisconnected)
+from typing import Optional
+from celery import Celery
 from flask import Flask, request, render_template, Response, jsonify, url_for
 from flask_mail import Mail, Message
-from sqlalchemy import create_engine, Table, Column, Integer, String, ForeignKey, UniqueConstraint
-from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.ext.orderinglist import ordering_list
-from uuid import uuid4
+from sqlalchemy import create_engine, delete, insert, select, ForeignKey, UniqueConstraint
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, scoped_session, sessionmaker, relationship
 
 app = Flask(__name__)
 app.config.from_pyfile('irv.cfg')
 
 mail = Mail(app)
 
+celery = Celery(app.import_name, broker=app.config.get('CELERY_BROKER_URL'))
+# Without a broker, mail is sent inline so the app works standalone.
+celery.conf.task_always_eager = 'CELERY_BROKER_URL' not in app.config
+
+# Errors worth reconnecting for; other SMTP replies are final for a message.
+MAIL_CONNECTION_ERRORS = (SMTPServerDisconnected, SMTPConnectError, OSError)
+
+def send_message(conn, subject, recipient, body):
+    """Send one message over conn, logging and skipping a rejected recipient.
+
+    Connection errors are raised so the caller can reconnect and retry.
+    """
+    try:
+        conn.send(Message(subject, recipients=[recipient], body=body))
+    except SMTPConnectError:
+        raise
+    except (SMTPRecipientsRefused, SMTPResponseException):
+        app.logger.exception("Mail to %s was rejected", recipient)
+
+@celery.task(autoretry_for=MAIL_CONNECTION_ERRORS, retry_backoff=True)
+def send_mail(subject, recipient, body):
+    with app.app_context(), mail.connect() as conn:
+        send_message(conn, subject, recipient, body)
+
+def send_all_mail(messages):
+    """Send (subject, recipient, body) messages, logging any that fail.
+
+    With a broker each message is queued as its own task, which Celery
+    retries. Otherwise the whole batch is sent inline over a single SMTP
+    connection, reconnecting after connection errors up to
+    MAIL_SEND_ATTEMPTS times for whatever is still unsent; a rejected
+    recipient is logged and skipped. Inline delivery is best-effort.
+    """
+    if not celery.conf.task_always_eager:
+        for subject, recipient, body in messages:
+            try:
+                send_mail.delay(subject, recipient, body)
+            except Exception:
+                app.logger.exception("Failed to queue mail to %s", recipient)
+        return
+    pending = list(messages)
+    attempts = app.config.get('MAIL_SEND_ATTEMPTS', 3)
+    with app.app_context():
+        for attempt in range(1, attempts + 1):
+            try:
+                with mail.connect() as conn:
+                    while pending:
+                        send_message(conn, *pending[0])
+                        pending.pop(0)
+                return
+            except MAIL_CONNECTION_ERRORS:
+                app.logger.warning("Mail attempt %d of %d failed",
+                        attempt, attempts, exc_info=True)
+                if attempt < attempts:
+                    time.sleep(2 ** attempt)
+        app.logger.error("Failed to send mail to %s",
+                ", ".join(recipient for _, recipient, _ in pending))
+
 class InvalidUsage(Exception):
     status_code = 400
 
@@ -33,23 +96,47 @@ def handle_invalid_usage(error):
     response.status_code = error.status_code
     return response
 
-engine = create_engine(app.config['DATABASE'], echo=True)
-Session = sessionmaker(bind=engine)
-session = Session()
+static_pages = {}
+
+def render_static(template_name):
+    """Render a template that takes no context, reusing the first render.
+
+    Caching is skipped while templates auto-reload (e.g. in debug mode).
+    """
+    if app.jinja_env.auto_reload:
+        return render_template(template_name)
+    if template_name not in static_pages:
+        static_pages[template_name] = render_template(template_name)
+    return static_pages[template_name]
+
+def generate_keys(count):
+    """Return count random 128-bit URL-safe keys."""
+    return [secrets.token_urlsafe(16) for _ in range(count)]
+
+engine = create_engine(app.config['DATABASE'],
+        echo=app.config.get('SQL_ECHO', False),
+        pool_pre_ping=True,
+        future=True)
+session = scoped_session(sessionmaker(bind=engine))
 
-Base = declarative_base()
+@app.teardown_appcontext
+def remove_session(exception=None):
+    session.remove()
+
+class Base(DeclarativeBase):
+    pass
 
 class Election(Base):
     __tablename__ = 'elections'
 
-    id = Column(Integer, primary_key=True)
-    name = Column(String)
-    key = Column(String)
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[Optional[str]]
+    key: Mapped[Optional[str]]
 
-    positions = relationship('Position', order_by='Position.rank',
-                                collection_class=ordering_list('rank'),
-                                back_populates='election')
-    voters = relationship('Voter', back_populates='election')
+    positions: Mapped[list['Position']] = relationship(order_by='Position.rank',
+            back_populates='election', lazy='raise_on_sql')
+    voters: Mapped[list['Voter']] = relationship(back_populates='election',
+            lazy='raise_on_sql')
 
     def __str__(self):
         return self.name
@@ -58,13 +145,15 @@ class Election(Base):
 class Position(Base):
     __tablename__ = 'positions'
 
-    id = Column(Integer, primary_key=True)
-    name = Column(String)
-    rank = Column(Integer)
-    election_id = Column(Integer, ForeignKey('elections.id'))
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[Optional[str]]
+    rank: Mapped[Optional[int]]
+    election_id: Mapped[Optional[int]] = mapped_column(ForeignKey('elections.id'), index=True)
 
-    election = relationship('Election', back_populates='positions')
-    candidates = relationship('Candidate', back_populates='position')
+    election: Mapped[Optional['Election']] = relationship(back_populates='positions',
+            lazy='raise_on_sql')
+    candidates: Mapped[list['Candidate']] = relationship(back_populates='position',
+            lazy='raise_on_sql')
 
     def __str__(self):
         return self.name
@@ -72,12 +161,14 @@ class Position(Base):
 class Candidate(Base):
     __tablename__ = 'candidates'
 
-    id = Column(Integer, primary_key=True)
-    name = Column(String)
-    position_id = Column(Integer, ForeignKey('positions.id'))
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[Optional[str]]
+    position_id: Mapped[Optional[int]] = mapped_column(ForeignKey('positions.id'), index=True)
 
-    position = relationship('Position', back_populates='candidates')
-    votes = relationship('Vote', back_populates='candidate')
+    position: Mapped[Optional['Position']] = relationship(back_populates='candidates',
+            lazy='raise_on_sql')
+    votes: Mapped[list['Vote']] = relationship(back_populates='candidate',
+            lazy='raise_on_sql')
 
     def __str__(self):
         return self.name
@@ -85,33 +176,45 @@ class Candidate(Base):
 class Vote(Base):
     __tablename__ = 'votes'
     __table_args__ = (
-            UniqueConstraint('voter_id', 'candidate_id', name='unique_rank_candidate'),
-            UniqueConstraint('rank', 'candidate_id', name='unique_rank_candidate'),
+            UniqueConstraint('voter_id', 'candidate_id', name='unique_voter_candidate'),
+            UniqueConstraint('voter_id', 'position_id', 'rank', name='unique_voter_position_rank'),
             )
 
-    id = Column(Integer, primary_key=True)
-    rank = Column(Integer)
-    candidate_id = Column(Integer, ForeignKey('candidates.id'))
-    voter_id = Column(Integer, ForeignKey('voters.id'))
+    id: Mapped[int] = mapped_column(primary_key=True)
+    rank: Mapped[Optional[int]]
+    candidate_id: Mapped[Optional[int]] = mapped_column(ForeignKey('candidates.id'), index=True)
+    position_id: Mapped[Optional[int]] = mapped_column(ForeignKey('positions.id'), index=True)
+    voter_id: Mapped[Optional[int]] = mapped_column(ForeignKey('voters.id'), index=True)
 
-    candidate = relationship('Candidate', back_populates='votes')
-    voter = relationship('Voter', back_populates='votes')
+    candidate: Mapped[Optional['Candidate']] = relationship(back_populates='votes',
+            lazy='raise_on_sql')
+    voter: Mapped[Optional['Voter']] = relationship(back_populates='votes',
+            lazy='raise_on_sql')
 
 class Voter(Base):
     __tablename__ = 'voters'
 
-    id = Column(Integer, primary_key=True)
-    key = Column(String)
-    election_id = Column(Integer, ForeignKey('elections.id'))
+    id: Mapped[int] = mapped_column(primary_key=True)
+    key: Mapped[Optional[str]] = mapped_column(index=True, unique=True)
+    election_id: Mapped[Optional[int]] = mapped_column(ForeignKey('elections.id'), index=True)
+
+    election: Mapped[Optional['Election']] = relationship(back_populates='voters',
+            lazy='raise_on_sql')
+    votes: Mapped[list['Vote']] = relationship(back_populates='voter',
+            lazy='raise_on_sql')
 
-    election = relationship('Election', back_populates='voters')
-    votes = relationship('Vote', back_populates='voter')
+# Dynamic relationships re-query on every access; load collections with
+# selectinload or query them explicitly instead.
+for mapper in Base.registry.mappers:
+    for relationship_property in mapper.relationships:
+        if relationship_property.lazy == 'dynamic':
+            raise ValueError("%s uses lazy='dynamic'" % relationship_property)
 
 Base.metadata.create_all(engine)
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_static('index.html')
 
 @app.route('/election', methods = ['GET', 'POST'])
 def create_election():
@@ -135,80 +238,123 @@ def create_election():
     }
     """
     if request.method == 'GET':
-        return render_template('create.html')
+        return render_static('create.html')
 
-    position_rank = 0
+    voter_emails = request.json['voter_emails']
+    keys = generate_keys(len(voter_emails) + 1)
     election = Election(name=request.json['name'])
-    election.key = str(uuid4())
-    for position_json in request.json['positions']:
-        position = Position(name=position_json['name'])
-        position.election = election
-        position.rank = position_rank
-        position_rank += 1
-        for candidate_name in position_json['candidates']:
-            candidate = Candidate(name=candidate_name)
-            candidate.position = position
+    election.key = keys[0]
     session.add(election)
+    session.flush()
+
+    positions_json = request.json['positions']
+    if positions_json:
+        session.execute(insert(Position), [
+            {"election_id": election.id, "name": position_json['name'],
+                "rank": position_rank}
+            for position_rank, position_json in enumerate(positions_json)])
+    position_ids = session.scalars(select(Position.id).
+            where(Position.election_id == election.id).
+            order_by(Position.rank)).all()
+    candidates = [{"position_id": position_id, "name": candidate_name}
+            for position_id, position_json in zip(position_ids, positions_json)
+            for candidate_name in position_json['candidates']]
+    if candidates:
+        session.execute(insert(Candidate), candidates)
+
+    voters = list(zip(voter_emails, keys[1:]))
+    if voters:
+        session.execute(insert(Voter), [
+            {"election_id": election.id, "key": voter_key}
+            for _, voter_key in voters])
     session.commit()
+
     manage_url = url_for("manage_election", election_id=election.id,
             _external=True) + "#" + election.key
-    mail.send(Message("Election Created",
-        recipients=[request.json['admin_email']],
-        body=manage_url))
-    for email in request.json['voter_emails']:
-        voter = Voter()
-        voter.election = election
-        voter.key = str(uuid4())
+    messages = [("Election Created", request.json['admin_email'], manage_url)]
+    for email, voter_key in voters:
         voter_url = url_for("vote_election", election_id=election.id,
-                _external=True) + "#" + voter.key
-        mail.send(Message("Vote in New Election",
-            recipients=[email],
-            body=voter_url))
-    session.add(election)
-    session.commit()
-    return jsonify({
+                _external=True) + "#" + voter_key
+        messages.append(("Vote in New Election", email, voter_url))
+
+    response = jsonify({
         "redirect": manage_url
         })
+    if celery.conf.task_always_eager:
+        # No broker: send after the response has been delivered.
+        response.call_on_close(lambda: send_all_mail(messages))
+    else:
+        send_all_mail(messages)
+    return response
 
 @app.route('/election/<int:election_id>/manage', methods = ['GET', 'POST'])
 def manage_election(election_id):
     if request.method == 'GET':
-        return render_template('manage.html')
+        return render_static('manage.html')
     return ''
 
 @app.route('/election/<int:election_id>/vote', methods = ['GET', 'POST'])
 def vote_election(election_id):
     if request.method == 'GET':
-        positions = session.query(Position).\
-                filter(Position.election_id == election_id).\
-                all()
+        rows = session.execute(select(Position.id, Position.name,
+                    Candidate.id, Candidate.name).
+                outerjoin(Candidate, Candidate.position_id == Position.id).
+                where(Position.election_id == election_id).
+                order_by(Position.rank, Position.id, Candidate.id)).all()
+        positions = [{
+            "id": position_id,
+            "name": position_name,
+            "candidates": [{"id": candidate_id, "name": candidate_name}
+                for _, _, candidate_id, candidate_name in position_rows
+                if candidate_id is not None]
+            } for (position_id, position_name), position_rows in
+            groupby(rows, key=itemgetter(0, 1))]
         return render_template('vote.html', positions=positions)
 
-    voter = session.query(Voter).\
-            filter(Voter.key == request.json['key']).\
-            filter(Voter.election_id == election_id).\
-            one()
-
-    old_votes = session.query(Vote).\
-            filter(Vote.voter==voter).\
-            join(Vote.candidate).\
-            join(Candidate.position).\
-            filter(Position.election_id==election_id).\
-            all()
-    for old_vote in old_votes:
-        session.delete(old_vote)
-    session.commit()
-
+    voter_id = session.execute(select(Voter.id).
+            where(Voter.key == request.json['key']).
+            where(Voter.election_id == election_id)).scalar_one_or_none()
+    if voter_id is None:
+        raise InvalidUsage('Unknown voter', status_code=404)
+
+    position_ids = [ballot['position_id'] for ballot in request.json['votes']]
+    position_candidates = {}
+    for position_id, candidate_id in session.execute(
+            select(Position.id, Candidate.id).
+            outerjoin(Candidate, Candidate.position_id == Position.id).
+            where(Position.id.in_(position_ids)).
+            where(Position.election_id == election_id)):
+        candidates = position_candidates.setdefault(str(position_id), set())
+        if candidate_id is not None:
+            candidates.add(str(candidate_id))
+    seen_position_ids = set()
     for ballot in request.json['votes']:
-        position = session.query(Position).\
-                filter(Position.id == ballot['position_id']).\
-                one()
-        rank = 1
-        for candidate_id in ballot['candidate_ids']:
-            vote = Vote(rank=rank, candidate_id=candidate_id, voter=voter)
-            rank += 1
-
-    session.add(voter)
+        position_id = str(ballot['position_id'])
+        if position_id not in position_candidates:
+            raise InvalidUsage('Position is not part of this election')
+        if position_id in seen_position_ids:
+            raise InvalidUsage('Position is voted on more than once')
+        seen_position_ids.add(position_id)
+        candidate_ids = [str(candidate_id)
+                for candidate_id in ballot['candidate_ids']]
+        if len(set(candidate_ids)) != len(candidate_ids):
+            raise InvalidUsage('Candidate is ranked more than once')
+        if not position_candidates[position_id].issuperset(candidate_ids):
+            raise InvalidUsage('Candidate is not running for this position')
+
+    election_positions = select(Position.id).\
+            where(Position.election_id == election_id)
+    session.execute(delete(Vote).
+            where(Vote.voter_id == voter_id).
+            where(Vote.position_id.in_(election_positions)),
+            execution_options={"synchronize_session": False})
+
+    votes = [{"rank": rank, "candidate_id": candidate_id,
+                "position_id": ballot['position_id'], "voter_id": voter_id}
+            for ballot in request.json['votes']
+            for rank, candidate_id in enumerate(ballot['candidate_ids'], 1)]
+    if votes:
+        session.execute(insert(Vote), votes)
     session.commit()
 
     return jsonify({
@@ -217,7 +363,7 @@ def vote_election(election_id):
 
 @app.route('/election/<int:election_id>/results', methods = ['GET'])
 def results_election(election_id):
-    return render_template('results.html')
+    return render_static('results.html')
 
 if __name__ == '__main__':
     app.run()